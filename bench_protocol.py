@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2017 Cody Harrington
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+:title: bench_protocol.py
+:description: Microbenchmark of packet encoding and decoding
+
+Usage:
+
+bench_protocol.py [iterations]
+
+Prints the number of encode and decode operations per second for the read
+request and read response packets, which make up nearly all of the traffic
+in a transfer. The ad-hoc struct.pack and slicing code that the client and
+server used before protocol.py is timed alongside for comparison.
+
+The protocol.py versions call the same encode and decode functions as the
+server and client. The file data of a read response is read from a real file,
+as it is in the server, one block after another as in a transfer.
+"""
+from timeit import default_timer
+from itertools import cycle
+import os
+import sys
+import tempfile
+import struct
+from protocol import (READ_RESPONSE_HEADER_SIZE, READ_REQUEST_TYPE, READ_RESPONSE_TYPE,
+                      ReadResponseBuffer, encode_read_request, encode_read_response,
+                      decode_request, decode_response)
+
+DATA = "x" * 1400
+READ_REQUEST_BYTES = struct.pack("!6I", 0b1101, 0b0001, 1, 1, 0, 1400)
+READ_RESPONSE_BYTES = struct.pack('!2IH3IQ', 0b1101, 0b0010, 0, 1, 1, 0, len(DATA)) + DATA
+
+read_response = ReadResponseBuffer()
+
+# Number of blocks in the data file, which are read in order, then from the start again
+NUM_BLOCKS = 64
+adhoc_start_positions = cycle(xrange(0, NUM_BLOCKS * len(DATA), len(DATA)))
+start_positions = cycle(xrange(0, NUM_BLOCKS * len(DATA), len(DATA)))
+
+
+def handle_read_request():
+    pass
+
+
+request_handlers = {READ_REQUEST_TYPE: handle_read_request}
+
+# Opened by open_data_file(). Each version has its own, as the server does for each client.
+adhoc_data_file = None
+data_file = None
+
+
+def open_data_file():
+    """
+    Writes NUM_BLOCKS of DATA to a temporary file, and opens it as adhoc_data_file and 
+    data_file. Returns the file name.
+    """
+    global adhoc_data_file, data_file
+    (data_fd, data_filename) = tempfile.mkstemp()
+    os.write(data_fd, DATA * NUM_BLOCKS)
+    os.close(data_fd)
+    adhoc_data_file = open(data_filename, "rb")
+    data_file = open(data_filename, "rb")
+    return data_filename
+
+
+def adhoc_encode_read_request():
+    return struct.pack("!6I", 0b1101, 0b0001, 1, 1, 0, 1400)
+
+
+def protocol_encode_read_request():
+    return encode_read_request(1, 1, 0, 1400)
+
+
+def adhoc_decode_read_request():
+    packet = READ_REQUEST_BYTES
+    bit_signature = packet[:4]
+    request_type = packet[4:8]
+    payload = packet[8:]
+    if bit_signature == "\x00\x00\x00\r":
+        if request_type == "\x00\x00\x00\x09":
+            pass
+        elif request_type == "\x00\x00\x00\x01":
+            return handle_read_request, struct.unpack("!4I", payload)
+
+
+def protocol_decode_read_request():
+    fields = decode_request(READ_REQUEST_BYTES)
+    if fields is not None:
+        return request_handlers[fields[1]], fields
+
+
+def adhoc_encode_read_response():
+    start_position = next(adhoc_start_positions)
+    adhoc_data_file.seek(start_position)
+    read_buffer = adhoc_data_file.read(1400)
+    header = struct.pack('!2IH3IQ', 0b1101, 0b0010, 0, 1, 1, start_position, len(read_buffer))
+    return header + read_buffer
+
+
+def protocol_encode_read_response():
+    return encode_read_response(read_response, 0, 1, 1, next(start_positions), data_file, 1400)
+
+
+def adhoc_decode_read_response():
+    packet = READ_RESPONSE_BYTES
+    bit_signature = packet[0:4]
+    response_type = packet[4:8]
+    payload = memoryview(packet)[8:]
+    if bit_signature == "\x00\x00\x00\r" and response_type == "\x00\x00\x00\x02":
+        return struct.unpack('!H3IQ', payload[:22]), payload[22:]
+
+
+def protocol_decode_read_response():
+    packet = READ_RESPONSE_BYTES
+    fields = decode_response(packet, READ_RESPONSE_TYPE)
+    if fields is not None:
+        return fields, memoryview(packet)[READ_RESPONSE_HEADER_SIZE:]
+
+
+def ops_per_second(func, iterations, repeat=15):
+    """
+    Calls func iterations times, and returns the number of calls per second.
+    This is repeated, and the fastest run is kept to reduce noise.
+    """
+    best = None
+    for run in xrange(repeat):
+        start = default_timer()
+        for i in xrange(iterations):
+            func()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return iterations / best
+
+
+def main():
+    try:
+        iterations = int(sys.argv[1])
+    except IndexError:
+        iterations = 200000
+    except ValueError:
+        sys.exit("Usage:\n\nbench_protocol.py [iterations]")
+
+    benchmarks = [
+        ("encode read request", adhoc_encode_read_request, protocol_encode_read_request),
+        ("decode read request", adhoc_decode_read_request, protocol_decode_read_request),
+        ("encode read response", adhoc_encode_read_response, protocol_encode_read_response),
+        ("decode read response", adhoc_decode_read_response, protocol_decode_read_response),
+    ]
+    print "%-22s %14s %14s" % ("", "ad-hoc ops/s", "protocol ops/s")
+    data_filename = open_data_file()
+    try:
+        for (name, adhoc, precompiled) in benchmarks:
+            print "%-22s %14d %14d" % (name, ops_per_second(adhoc, iterations),
+                                       ops_per_second(precompiled, iterations))
+    finally:
+        adhoc_data_file.close()
+        data_file.close()
+        os.remove(data_filename)
+
+
+if __name__ == '__main__':
+    main()
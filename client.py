@@ -20,7 +20,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
 :title: client.py
-:description: Client to download files from server
+:description: Client to download files from server. Run as a script to save a file locally, 
+or import download() to stream a file as memoryview chunks.
 
 Summary of packet types:
 1 = 0b0001 = read request = \x00\x00\x00\x01
@@ -33,8 +34,15 @@ Summary of packet types:
 from socket import *
 import sys
 import select
-import struct
 import random
+import time
+from protocol import (READ_RESPONSE_HEADER_SIZE, READ_RESPONSE_TYPE, OPEN_RESPONSE_TYPE,
+                      encode_open_request, encode_read_request, encode_close_request,
+                      decode_response)
+
+class TransferError(Exception):
+    """Raised when a file cannot be received from the server."""
+    pass
 
 class Client(object):
 
@@ -42,31 +50,31 @@ class Client(object):
     epoch_no = 0
     handle_no = 0
     
-    def __init__(self):
-        """Sets up UDP socket, obtains 5 values at command line:
+    def __init__(self, file_read, ip, port, p=0.0, verbose=False):
+        """Sets up UDP socket, and stores the 4 values needed for a transfer:
         Filename to be read from server
-        Filename under which received file is to be stored locally
         IP address or hostname of server (localhost if client is run on same machine)
         Port number of server
 	Probability of packet loss, p
+	Output for each packet sent and received is only printed if verbose is True.
 	"""
+	if (len(file_read) > 100):
+	    raise ValueError("Name of file must be equal to or less than 100 characters.")
         self.client_socket = socket(AF_INET, SOCK_DGRAM)
 	# Value for number of bytes socket can receive. ( For best match with hardware and network realities, 
 	# the value should be a relatively small power of 2, for example, 4096)
 	self.buffer_ = 2048 
 	
-	self.file_read = self.get_file_read_arg()
-	self.local_filename = self.get_local_filename_arg()
-	self.ip = self.get_ip_arg()
-	self.port = self.get_port_arg()
-	self.p = self.get_p_arg()
+	self.file_read = file_read
+	self.ip = ip
+	self.port = port
+	self.p = p
 	self.address = (self.ip, self.port)
-	
-	# Create file on local system with name provided, to write our received file to
-	self.file_write = open(self.local_filename, 'wb')
 	self.eof = False
+	self.verbose = verbose
 
-    def get_file_read_arg(self):
+    @staticmethod
+    def get_file_read_arg():
 	"""Gets the name of the file to receive from the command line.
 	Throws an error if it is empty or more than 100 characters."""
 	try:
@@ -81,7 +89,8 @@ class Client(object):
 	else:
 	    return file_read
 	
-    def get_local_filename_arg(self):
+    @staticmethod
+    def get_local_filename_arg():
 	"""Gets the name under which received file is to be stored locally, from the command line.
 	Throws an error if it is empty."""
 	try:
@@ -93,7 +102,8 @@ class Client(object):
 	else:
 	    return local_filename
 	
-    def get_ip_arg(self):
+    @staticmethod
+    def get_ip_arg():
 	"""Gets the ip number or hostname of the server from the command line.
 	Throws an error if it is empty."""   
 	try:
@@ -105,7 +115,8 @@ class Client(object):
 	else:
 	    return ip
     
-    def get_port_arg(self):
+    @staticmethod
+    def get_port_arg():
 	"""Gets the port number of the server from the command line.
 	Throws an error if it is empty, not an integer, or not in the range of 1024 - 60000."""
 	try:
@@ -123,7 +134,8 @@ class Client(object):
 	else:
 	    return port
     
-    def get_p_arg(self):
+    @staticmethod
+    def get_p_arg():
 	"""Gets the probability of packet loss, p, from the command line.
 	Throws an error if it is empty, or not a float in the range of 0.0 - 1.0."""
 	try:
@@ -138,15 +150,16 @@ class Client(object):
 	else:
 	    return p
 	
-    def recv_invalid_response(self, recv_data, invalid_type = ""):
-	"""When bit signature is invalid or wrong packet type is received, 
-	discard packet and print error message."""	
-	if (invalid_type == "bit_signature"):
-	    print("Error: Packet received from outside our network (wrong bit signature)")	    
-	    recv_data = ""	    
-	elif (invalid_type == "response_type"):
-	    print("Error: Wrong response type in packet received.")	    
-	    recv_data = ""	   	
+    def log(self, message, *args):
+	"""Prints message, formatted with args, if verbose output was asked for."""
+	if self.verbose:
+	    print message % args if args else message
+    
+    def recv_invalid_response(self, recv_data):
+	"""When packet is too short, bit signature is invalid or wrong packet type is received, 
+	discard packet and print error message."""
+	self.log("Error: Invalid packet received (too short, wrong bit signature or wrong response type).")
+	recv_data = ""
 	return
     
   
@@ -157,30 +170,27 @@ class Client(object):
 	4 bytes - open request type - 0b0100
 	100 bytes - filename to be read as ASCII string
 	"""
-	print "Sending open request for file named ", self.file_read
-	send_data = struct.pack("!2I100s", 0b1101, 0b0100, self.file_read)
+	self.log("Sending open request for file named %s", self.file_read)
+	send_data = encode_open_request(self.file_read)
 	self.client_socket.sendto(send_data, self.address)
 	return
     
-    def recv_open_response(self, recv_payload):
+    def recv_open_response(self, fields):
         """When client receives an (already-validated) open-response packet from the server, 
-	it unpacks the payload and saves the received fields as instance variables if file found."""
+	it takes the unpacked fields and saves them as instance variables if file found."""
 
-	unpacked_payload = struct.unpack("!?Q2I", recv_payload)
+	(bit_signature, response_type, status, file_length, epoch_no, handle_no) = fields
         # Read status field. If set to False, ignore remaining fields and 
-	# generate error msg (file not found) before exiting. 
-	# Each unpacked value is a tuple, so [0] accesses the value that we want
-	status = unpacked_payload[0:1][0]
+	# raise an error (file not found). 
 	if status == False:
-	    print "Error: File not found."
-	    sys.exit()
+	    raise TransferError("File not found.")
 	
 	#If set to True, read remaining fields.
 	elif status == True:
-	    print("File found.")
-	    self.file_length = unpacked_payload[1:2][0]
-	    self.epoch_no = unpacked_payload[2:3][0]
-	    self.handle_no = unpacked_payload[3:][0]	    	    
+	    self.log("File found.")
+	    self.file_length = file_length
+	    self.epoch_no = epoch_no
+	    self.handle_no = handle_no
 	return
     
     def send_read_request(self, start_position):
@@ -193,53 +203,39 @@ class Client(object):
 	4 bytes - start position of the block to be read from the file - incremented sequentially
 	4 bytes - number of bytes to read - 1400
 	"""
-	send_data = struct.pack("!6I", 0b1101, 0b0001, self.epoch_no, self.handle_no, start_position, self.NUM_BYTES_TO_READ)
-	self.client_socket.sendto(send_data, self.address)	
+	send_data = encode_read_request(self.epoch_no, self.handle_no, start_position, self.NUM_BYTES_TO_READ)
+	self.client_socket.sendto(send_data, self.address)
 	return
     
-    def recv_read_response(self, recv_payload):
-        """When client receives an (already-validated) read-response packet from the server, it unpacks payload,
-	checks that epoch number and handle number are correct and status field is 'OK',
-	and appends file data received to the local file at the given start position."""       
-	#Only unpack the headers because we want to store the file data as binary
-	unpacked_payload = struct.unpack('!H3IQ', recv_payload[:22])
-	status = unpacked_payload[0:1][0]
-	epoch_no = unpacked_payload[1:2][0]
-	handle_no = unpacked_payload[2:3][0]	
+    def recv_read_response(self, fields, recv_data):
+        """When client receives an (already-validated) read-response packet from the server, it takes the 
+	unpacked header fields, checks that epoch number and handle number are correct and status field is 'OK',
+	and returns the start position of the block along with the file data received, as a memoryview 
+	over the packet, without copying it."""       
+	(bit_signature, response_type, status, epoch_no, handle_no, 
+	 start_position, num_bytes_been_read) = fields
 	
 	#Check that file handle is the same, to make sure it is the same file request.
 	if (self.epoch_no == epoch_no and self.handle_no == handle_no):
-	    start_position = unpacked_payload[3:4][0]
-	    num_bytes_been_read = unpacked_payload[4:5][0]    
-	    # If we receive less bytes than the number we requested to read, this means that
-	    # end of file has been reached
-	    if (num_bytes_been_read < self.NUM_BYTES_TO_READ):
-		self.eof = True
-	    data_to_write = recv_payload[22:]	    
-	    #If status field says that response contains real data: Append to file. Otherwise react 
+	    data_to_write = memoryview(recv_data)[READ_RESPONSE_HEADER_SIZE:]
+	    #If status field says that response contains real data: Return it. Otherwise react 
 	    #depending on error code received.
 	    #Status 00 = OK
 	    #Status 01 = Epoch no. of file handle doesnt match epoch no. of current invocation
 	    #Status 10 = No context found for file-handle and no data has been read
 	    #Status 11 = Context could be found but start position out of range
 	    if (status == 0b00):
-		self.file_append.seek(start_position)
-		self.file_append.write(data_to_write)
+		return start_position, data_to_write
 	    elif (status == 0b01):
-		print("Error: Epoch no. of file handle doesnt match epoch no. of current invocation")
-		sys.exit()
+		raise TransferError("Epoch no. of file handle doesnt match epoch no. of current invocation")
 	    elif (status == 0b10):
-		print("Error: No context found for file-handle and no data has been read")
-		sys.exit()
+		raise TransferError("No context found for file-handle and no data has been read")
 	    elif(status == 0b11):
-		print("Error: Context could be found but start position out of range")
-		sys.exit()
+		raise TransferError("Context could be found but start position out of range")
+	    else:
+		raise TransferError("Unknown status " + str(status) + " in read response.")
 	else:
-	    print("Error: File handle does not match file handle stored in client. Wrong file received.")
-	    sys.exit() 	    
-	#Then return control to read_service_loop() method so that next iteration of send_read_request 
-	#from new start position is called.
-        return
+	    raise TransferError("File handle does not match file handle stored in client. Wrong file received.")
     
        
     def send_close_request(self):
@@ -250,7 +246,7 @@ class Client(object):
 	4 bytes - epoch number
 	4 bytes - handle number
 	"""
-	data = struct.pack("!4I", 0b1101, 0b1001, self.epoch_no, self.handle_no)
+	data = encode_close_request(self.epoch_no, self.handle_no)
 	self.client_socket.sendto(data, self.address)
 	self.client_socket.close()	
         return
@@ -259,7 +255,7 @@ class Client(object):
 	"""Loop that governs the timing and retransmission of open request packets,
 	then checks packets received for the bit signature and response type fields to ensure that they are correct."""
 	
-	print "Attempting to receive file", self.file_read, "from", self.ip, "at port", self.port, "." 
+	self.log("Attempting to receive file %s from %s at port %d.", self.file_read, self.ip, self.port)
 	recv_data = None
 	num_retransmits = 0
 	#Start timer, retransmit after each timeout of one second. If receive response within the timer, move on to next step. 
@@ -277,92 +273,148 @@ class Client(object):
 		try:
 		    recv_data = self.client_socket.recv(self.buffer_)
 		except Exception as exception_:
-		    print("Wrong port number or IP address provided, or server is not available at the moment.")
-		    sys.exit()
-		print("Received a packet.")
+		    raise TransferError("Wrong port number or IP address provided, or server is not available at the moment.")
+		self.log("Received a packet.")
 		
 		#Generate a random number between 0 and 1 with uniform distribution to simulate packet loss.
 		if (random.uniform(0,1) < self.p):
 		    recv_data = None
-		    print("Packet dropped randomly to simulate packet losses")
+		    self.log("Packet dropped randomly to simulate packet losses")
 		    continue
 		
-		bit_signature = recv_data[0:4]
-		response_type = recv_data[4:8]
-		recv_payload = recv_data[8:]
-
-		#Check that bit signature is valid (packet is from our network)
-		if bit_signature != "\x00\x00\x00\r": 
-		    recv_invalid_response(recv_data, "bit_signature")
+		#Check that bit signature is valid (packet is from our network), and the response type.
+		#We have only ever sent a open_request, so the only viable response at this point is an open_response. 
+		#If this field contains anything else, it is an invalid packet. Retransmit request.
+		fields = decode_response(recv_data, OPEN_RESPONSE_TYPE)
+		if fields is None:
+		    self.recv_invalid_response(recv_data)
 		    continue
 		else:
-		    #We have only ever sent a open_request, so the only viable response at this point is an open_response. 
-		    #If this field contains anything else, it is an invalid packet. Retransmit request.
-		    if response_type != "\x00\x00\x00\x08": 
-			self.recv_invalid_response(recv_data, "response_type")
-			continue		
-		    else:
-			#Bit signature and response type fields are both valid.
-			print("Received open response from server...")
-			self.recv_open_response(recv_payload)
-			break
+		    #Bit signature and response type fields are both valid.
+		    self.log("Received open response from server...")
+		    self.recv_open_response(fields)
+		    break
 	
 	if (num_retransmits >= 60):
-	    print ("Exceeded number of retransmissions allowed. Exiting program.")
-	    sys.exit()	
+	    raise TransferError("Exceeded number of retransmissions allowed.")
 	return
     
+    def wait_read_response(self, start_position):
+	"""Waits up to one second for the read response to the block at start_position, and returns its file data 
+	as a memoryview, or None if the timer expires so that the read request is retransmitted.
+	Any other packet received in the meantime is dropped without sending another read request. This includes a late 
+	or duplicated response for a block we already have: the server answers every request it receives, so sending one 
+	for each extra response would keep the extra responses coming for the rest of the transfer."""
+	deadline = time.time() + 1
+	input_socket = [self.client_socket]
+	while True:
+	    remaining = deadline - time.time()
+	    if (remaining <= 0):
+		return None
+	    inputready,outputready,exceptready = select.select(input_socket,[],[], remaining)
+	    if (inputready == []):
+		return None
+	    try:
+		recv_data = self.client_socket.recv(self.buffer_)
+	    except Exception as exception_:
+		raise TransferError("Wrong port number or IP address provided, or server is not available at the moment.")
+	    if (random.uniform(0,1) < self.p):
+		recv_data = None
+		self.log("Packet dropped randomly to simulate packet losses")
+		continue
+	    fields = decode_response(recv_data, READ_RESPONSE_TYPE)
+	    if fields is None:
+		self.recv_invalid_response(recv_data)
+		continue
+	    #Packet is valid, proceed to recv_read_response to extract this bit of file received
+	    (chunk_position, chunk) = self.recv_read_response(fields, recv_data)
+	    #A late or duplicated response must not be passed on as the next chunk
+	    if (chunk_position != start_position):
+		self.log("Dropped response for byte %d, expected byte %d", chunk_position, start_position)
+		continue
+	    return chunk
+    
     def read_service_loop(self):
-	"""Loop that governs the timing and retransmission of read request packets,
-	then checks packets received for the bit signature and response type fields to ensure that they are correct."""
+	"""Loop that governs the timing and retransmission of read request packets.
+	This is a generator, yielding the data of each read response as a memoryview, in file order."""
 	
 	#Increment start_position each time packet sent, send a read request packet for each new position.
 	#Expect to receive a read_response packet for each time read request sent.
-	recv_data = None
-	print("Sending request to server to read and receive file...")
+	self.log("Sending request to server to read and receive file...")
 	start_position = 0
 	while(self.eof == False):
-	    print("Reading from byte " + str(start_position))	    
-	    num_retransmits = 0    
-	    #Loop for retransmissions of the same start position
-	    while(num_retransmits < 60):
+	    self.log("Reading from byte %d", start_position)	    
+	    num_retransmits = 0
+	    chunk = None
+	    #Retransmit the request for the same start position each time the timer expires.
+	    #Limit number of retransmits to 60 so as not to enter infinite loop.
+	    while(chunk is None):
+		if (num_retransmits >= 60):
+		    raise TransferError("Exceeded number of retransmissions allowed.")
 		num_retransmits = num_retransmits + 1
 		self.send_read_request(start_position)
-		input_socket = [self.client_socket]
-		inputready,outputready,exceptready = select.select(input_socket,[],[], 1)		
-		if (inputready == []):
-		    continue		
-		else:
-		    recv_data = self.client_socket.recv(self.buffer_)		    
-		    if (random.uniform(0,1) < self.p):
-			recv_data = None
-			print("Packet dropped randomly to simulate packet losses")
-			continue		    
-		    bit_signature = recv_data[0:4]
-		    response_type = recv_data[4:8]
-		    recv_payload = recv_data[8:]	    
-		    if bit_signature != "\x00\x00\x00\r":
-			self.recv_invalid_response(recv_data, "bit_signature")
-			continue
-		    else:
-			if response_type == "\x00\x00\x00\x02":
-			    #Packet is valid, proceed to recv_read_response to append this bit of file received into local_filename
-			    self.file_append = open(self.local_filename, 'r+b')
-			    self.recv_read_response(recv_payload)
-			    break
-			else:
-			    self.recv_invalid_response(recv_data, "response_type")
-			    continue
-		
-	    start_position = start_position + self.NUM_BYTES_TO_READ		
-	    if (num_retransmits >= 60):
-		print ("Exceeded number of retransmissions allowed. Exiting program.")
-		sys.exit()	    		
+		chunk = self.wait_read_response(start_position)
+	    # If we receive less bytes than the number we requested to read, this means that
+	    # end of file has been reached
+	    if (len(chunk) < self.NUM_BYTES_TO_READ):
+		self.eof = True
+	    start_position = start_position + self.NUM_BYTES_TO_READ
+	    yield chunk
 	return
+    
+    def iter_chunks(self):
+	"""Performs the whole transfer: opens the file on the server, reads it and closes it again.
+	This is a generator, yielding the file data as ordered memoryview chunks. The close request 
+	is also sent if the caller stops iterating early."""
+	try:
+	    self.open_service_loop()
+	except:
+	    self.client_socket.close()
+	    raise
+	try:
+	    for chunk in self.read_service_loop():
+		yield chunk
+	finally:
+	    self.send_close_request()
+
+
+def download(file_read, address, p=0.0, verbose=False):
+    """Downloads the file named file_read from the server at address, a (host, port) tuple.
+    Returns an iterator over the file data as ordered memoryview chunks, so that it can be fed 
+    straight into a parser, hash or pipe without writing a temporary file.
+    Nothing is printed unless verbose is True.
+    Raises TransferError if the transfer fails."""
+    client = Client(file_read, address[0], address[1], p, verbose)
+    return client.iter_chunks()
+
+
+def main():
+    """Obtains 5 values at command line:
+    Filename to be read from server
+    Filename under which received file is to be stored locally
+    IP address or hostname of server (localhost if client is run on same machine)
+    Port number of server
+    Probability of packet loss, p
+    and downloads the file into the local file."""
+    file_read = Client.get_file_read_arg()
+    local_filename = Client.get_local_filename_arg()
+    ip = Client.get_ip_arg()
+    port = Client.get_port_arg()
+    p = Client.get_p_arg()
+    
+    client = Client(file_read, ip, port, p, verbose=True)
+    # Create file on local system with name provided, to write our received file to
+    file_write = open(local_filename, 'wb')
+    try:
+        for chunk in client.iter_chunks():
+            file_write.write(chunk)
+    except TransferError as exception_:
+        print "Error:", exception_
+        sys.exit()
+    finally:
+        file_write.close()
+    print ("File received successfully. Program will now exit.")
+    sys.exit()
 
-client = Client()
-client.open_service_loop()
-client.read_service_loop()
-client.send_close_request()
-print ("File received successfully. Program will now exit.")
-sys.exit()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""
+Copyright (c) 2017 Cody Harrington
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+:title: protocol.py
+:description: Packet formats shared by the client and server
+
+Every packet starts with a header of two 4 byte fields, the bit signature
+(1101 = 13) and the packet type:
+1 = 0b0001 = read request
+2 = 0b0010 = read response
+4 = 0b0100 = open request
+8 = 0b1000 = open response
+9 = 0b1001 = close request
+
+Each packet type has a struct of its whole packet, header included, so that a
+packet is packed or parsed in one call. The bit signature and packet type of a
+received packet are then checked as integers.
+
+A read response also carries file data, so it is built in a reusable buffer
+instead. new_packet_buffer() packs the fixed header in once, and each send then
+only packs the payload fields in after it with pack_into().
+
+The encode and decode functions below, and ReadResponseBuffer, are the codec 
+that the client, the server and bench_protocol.py all use.
+"""
+from functools import partial
+import struct
+
+BIT_SIGNATURE = 0b1101
+
+READ_REQUEST_TYPE = 0b0001
+READ_RESPONSE_TYPE = 0b0010
+OPEN_REQUEST_TYPE = 0b0100
+OPEN_RESPONSE_TYPE = 0b1000
+CLOSE_REQUEST_TYPE = 0b1001
+
+# bit_signature packet_type
+HEADER = struct.Struct("!2I")
+HEADER_SIZE = HEADER.size
+
+# The payloads that follow the header for each packet type
+
+# file_name
+OPEN_REQUEST = struct.Struct("!100s")
+
+# status file_length epoch_number handle_number
+OPEN_RESPONSE = struct.Struct("!?Q2I")
+
+# epoch_number handle_number start_position num_bytes_to_read
+READ_REQUEST = struct.Struct("!4I")
+
+# status epoch_number handle_number start_position num_bytes_read,
+# followed by the bytes read
+READ_RESPONSE = struct.Struct("!H3IQ")
+
+# epoch_number handle_number
+CLOSE_REQUEST = struct.Struct("!2I")
+
+
+def packet_struct(payload):
+    """Returns the struct of a whole packet, the header followed by payload."""
+    return struct.Struct(HEADER.format + payload.format[1:])
+
+
+# The whole packets, header included
+OPEN_REQUEST_PACKET = packet_struct(OPEN_REQUEST)
+OPEN_RESPONSE_PACKET = packet_struct(OPEN_RESPONSE)
+READ_REQUEST_PACKET = packet_struct(READ_REQUEST)
+READ_RESPONSE_PACKET = packet_struct(READ_RESPONSE)
+CLOSE_REQUEST_PACKET = packet_struct(CLOSE_REQUEST)
+
+READ_RESPONSE_HEADER_SIZE = READ_RESPONSE_PACKET.size
+
+# Largest amount of file data that fits into a single UDP datagram after the 
+# read response header
+MAX_READ_SIZE = 65507 - READ_RESPONSE_HEADER_SIZE
+
+# Maps each packet type to the struct of its whole packet
+PACKET_TYPES = {
+    READ_REQUEST_TYPE: READ_REQUEST_PACKET,
+    READ_RESPONSE_TYPE: READ_RESPONSE_PACKET,
+    OPEN_REQUEST_TYPE: OPEN_REQUEST_PACKET,
+    OPEN_RESPONSE_TYPE: OPEN_RESPONSE_PACKET,
+    CLOSE_REQUEST_TYPE: CLOSE_REQUEST_PACKET,
+}
+
+# Minimum size of a packet of each type. Anything shorter must be dropped 
+# before it is parsed.
+PACKET_SIZES = dict((packet_type, packet.size) 
+                    for (packet_type, packet) in PACKET_TYPES.items())
+
+REQUEST_PACKET_TYPES = (READ_REQUEST_TYPE, OPEN_REQUEST_TYPE, CLOSE_REQUEST_TYPE)
+
+# Requests carry no data after their payload, so the size of a received 
+# request is enough to know which packet type it can be. decode_request() 
+# then checks the packet type field as well.
+REQUEST_TYPES = dict((PACKET_SIZES[packet_type], packet_type) 
+                     for packet_type in REQUEST_PACKET_TYPES)
+
+# A request type with the same size as another would silently replace it 
+# above, and every packet of the other type would be dropped
+assert len(REQUEST_TYPES) == len(REQUEST_PACKET_TYPES), \
+    "Every request type must have a different packet size"
+
+# The packet type and bound unpack method of the request of each size, which 
+# decode_request() looks up for every packet it receives
+REQUEST_DECODERS = dict((size, (packet_type, PACKET_TYPES[packet_type].unpack)) 
+                        for (size, packet_type) in REQUEST_TYPES.items())
+
+
+def new_packet_buffer(packet_type, payload, extra_size=0):
+    """
+    Returns a reusable buffer for packets of type packet_type, with the header
+    already packed in. payload is the struct of the payload, and extra_size is
+    any space needed after it, such as for the file data of a read response.
+    """
+    packet_buffer = bytearray(HEADER_SIZE + payload.size + extra_size)
+    HEADER.pack_into(packet_buffer, 0, BIT_SIGNATURE, packet_type)
+    return packet_buffer
+
+
+# Each of these takes the payload fields of its packet, in the order listed 
+# above, and returns the whole packet. They are partials of the packet structs 
+# rather than functions, so that they cost no more than a call to pack().
+encode_open_request = partial(OPEN_REQUEST_PACKET.pack, BIT_SIGNATURE, 
+                              OPEN_REQUEST_TYPE)
+encode_open_response = partial(OPEN_RESPONSE_PACKET.pack, BIT_SIGNATURE, 
+                               OPEN_RESPONSE_TYPE)
+encode_read_request = partial(READ_REQUEST_PACKET.pack, BIT_SIGNATURE, 
+                              READ_REQUEST_TYPE)
+encode_close_request = partial(CLOSE_REQUEST_PACKET.pack, BIT_SIGNATURE, 
+                               CLOSE_REQUEST_TYPE)
+
+
+def decode_request(packet):
+    """
+    Returns the unpacked fields of a request packet, header included, or None 
+    if packet is not a valid request. The packet type is fields[1].
+    """
+    try:
+        (request_type, unpack) = REQUEST_DECODERS[len(packet)]
+    except KeyError:
+        # No request type has this size
+        return None
+    fields = unpack(packet)
+    # Bit signature of 13 to identify our packets
+    if fields[0] != BIT_SIGNATURE or fields[1] != request_type:
+        return None
+    return fields
+
+
+def decode_response(packet, response_type):
+    """
+    Returns the unpacked fields of a response packet of type response_type, 
+    header included, or None if packet is not one. The file data of a read 
+    response follows the fields, from READ_RESPONSE_HEADER_SIZE on.
+    """
+    response_packet = PACKET_TYPES[response_type]
+    if len(packet) < response_packet.size:
+        return None
+    fields = response_packet.unpack_from(packet)
+    if fields[0] != BIT_SIGNATURE or fields[1] != response_type:
+        return None
+    return fields
+
+
+class ReadResponseBuffer(object):
+    """
+    Reusable buffer that read responses are built in by 
+    encode_read_response(). The file data is read straight into the buffer 
+    after the fields, so it is never copied.
+    """
+    
+    # Slots make the attributes quicker to get and set for each packet
+    __slots__ = ('packet_buffer', 'view', 'read_size', 'data_view', 'packet_view', 
+                 'f_handle', 'file_position')
+    
+    def __init__(self):
+        self.packet_buffer = new_packet_buffer(READ_RESPONSE_TYPE, READ_RESPONSE, 
+                                               MAX_READ_SIZE)
+        self.view = memoryview(self.packet_buffer)
+        # Views of the file data and of the whole packet for the last read 
+        # size. Every full block has the same size, so these are reused for 
+        # each one.
+        self.read_size = None
+        self.data_view = None
+        self.packet_view = None
+        # The file last read from, and its position after that read
+        self.f_handle = None
+        self.file_position = None
+
+
+# Bound once, rather than looked up for each read response
+pack_read_response = READ_RESPONSE.pack_into
+
+
+def encode_read_response(response_buffer, status, epoch_number, handle_number, 
+                         start_position, f_handle, read_size):
+    """
+    Reads up to read_size bytes from f_handle at start_position into 
+    response_buffer, a ReadResponseBuffer, packs the fields in front of them, 
+    and returns a memoryview of the read response. Errors from reading the 
+    file are raised, after which the position of f_handle is unknown and it 
+    must not be read from again.
+    
+    A client reads the blocks of a file in order, so the seek is skipped when 
+    f_handle is already at start_position after the last read.
+    
+    The returned view is only valid until response_buffer is used again.
+    """
+    if read_size != response_buffer.read_size:
+        # The size as requested is kept, so that the views are also reused 
+        # for requests larger than MAX_READ_SIZE
+        response_buffer.read_size = read_size
+        read_size = min(read_size, MAX_READ_SIZE)
+        response_buffer.data_view = response_buffer.view[READ_RESPONSE_HEADER_SIZE:
+                                                         READ_RESPONSE_HEADER_SIZE + read_size]
+        response_buffer.packet_view = response_buffer.view[:READ_RESPONSE_HEADER_SIZE + read_size]
+    if (f_handle is not response_buffer.f_handle or 
+            start_position != response_buffer.file_position):
+        f_handle.seek(start_position)
+    num_bytes_read = f_handle.readinto(response_buffer.data_view)
+    response_buffer.f_handle = f_handle
+    response_buffer.file_position = start_position + num_bytes_read
+    pack_read_response(response_buffer.packet_buffer, HEADER_SIZE, status, 
+                       epoch_number, handle_number, start_position, num_bytes_read)
+    if num_bytes_read == read_size:
+        return response_buffer.packet_view
+    return response_buffer.view[:READ_RESPONSE_HEADER_SIZE + num_bytes_read]
+
+
+def encode_read_error(response_buffer, status, epoch_number, handle_number, 
+                      start_position):
+    """
+    Returns a memoryview of a read response with an error status, which holds 
+    no data, built in response_buffer.
+    """
+    pack_read_response(response_buffer.packet_buffer, HEADER_SIZE, status, 
+                       epoch_number, handle_number, start_position, 0)
+    return response_buffer.view[:READ_RESPONSE_HEADER_SIZE]
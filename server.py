@@ -26,25 +26,63 @@ from time import clock
 from socket import *
 import os
 import sys
-import struct 
+import select
 import random
+import threading
+from protocol import (READ_REQUEST_TYPE, OPEN_REQUEST_TYPE, CLOSE_REQUEST_TYPE,
+                      ReadResponseBuffer, encode_open_response, encode_read_response,
+                      encode_read_error, decode_request)
 
 class Server(object):
-    def __init__(self):
-        """Start up the server"""
+    def __init__(self, port=0, p_err=0.0, ip=None, epoch_file='epoch.number', 
+                 verbose=False):
+        """
+        Set up the server. The socket is bound straight away, but no packets 
+        are handled until listen() or start() is called.
+        
+        A port of 0 binds to an ephemeral port, which is then available as 
+        self.port.
+        
+        epoch_file is the path of the file that the epoch number is kept in, 
+        and output for each packet is only printed if verbose is True.
+        """
         # This must be the address that the server is running on
-        self.ip = gethostbyname(gethostname()) # Change this as needed
-        self.port, self.p_err = self.get_args()
-        self.address = (self.ip, self.port)
+        if ip is None:
+            ip = gethostbyname(gethostname()) # Change this as needed
+        self.ip = ip
+        self.p_err = p_err
+        self.epoch_file = epoch_file
+        self.verbose = verbose
+        self.address = (self.ip, port)
         self.buffer_ = 2048 # Change as needed
+        # Reusable buffer that read responses are packed into
+        self.read_response = ReadResponseBuffer()
         self.udp_socket = self.init_socket()
+        self.port = self.udp_socket.getsockname()[1]
+        self.address = (self.ip, self.port)
         self.epoch_number = self.get_epoch_number();
         self.handle_number = 0
         self.context_record = {}
-        self.listen()
+        self.request_handlers = {
+            CLOSE_REQUEST_TYPE: self.recv_close_request,
+            READ_REQUEST_TYPE: self.send_read_response,
+            OPEN_REQUEST_TYPE: self.send_open_response,
+        }
+        self.stop_event = threading.Event()
+        self.listen_thread = None
+        
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
         
     
-    def get_args(self):
+    @staticmethod
+    def get_args():
         """
         Gets the port number and packet error threshold value. from the command line.
         
@@ -72,6 +110,16 @@ class Server(object):
             return port, p_err
             
     
+    def log(self, message, *args):
+        """
+        Prints message, formatted with args, if the server is verbose. The 
+        message is only formatted when it is printed, so that it costs next to 
+        nothing per packet otherwise.
+        """
+        if self.verbose:
+            print message % args if args else message
+            
+    
     def init_socket(self):
         """Creates socket for use. Returns an active UDP socket."""
         udp_socket = socket(AF_INET, SOCK_DGRAM)
@@ -83,17 +131,17 @@ class Server(object):
     
     def get_epoch_number(self):
         """
-        Checks to see if file "epoch.number" exists. If it doesn't, then 
-        epoch-number is set to 1, and stored in a file named "epoch.number"
+        Checks to see if the file self.epoch_file exists. If it doesn't, then 
+        epoch-number is set to 1, and stored in that file.
         Otherwise, the first line is read for a single integer, which is stored 
         as the epoch number. This number is then incremented by 1, and is 
         written into the file over the old number.
         """
-        if not os.path.isfile('epoch.number'):
+        if not os.path.isfile(self.epoch_file):
             epoch_number = 1
-            f = open('epoch.number', 'w')
+            f = open(self.epoch_file, 'w')
         else:
-            f = open('epoch.number', 'r+')
+            f = open(self.epoch_file, 'r+')
             f_string = f.readline()
         
             if f_string.isdigit():
@@ -106,14 +154,15 @@ class Server(object):
             
         f.write(str(epoch_number))
         f.close()
-        print "Retrieved epoch number: %d" % epoch_number
+        self.log("Retrieved epoch number: %d", epoch_number)
         
         return epoch_number
     
             
-    def send_open_response(self, packet, recv_addr):
+    def send_open_response(self, fields, recv_addr):
         """
-        Parses an open-request, then replies with an appropriate open-response.
+        Takes the unpacked fields of an open-request, then replies with an 
+        appropriate open-response.
         
         Receives: 
         file_name
@@ -121,13 +170,13 @@ class Server(object):
         Sends:
         Bit_signature packet_type status file_length epoch_number handle_number
         """
-        print "Received open request from %s on port %d." % recv_addr
-        (f_name,) = struct.unpack('!100s', packet)
+        self.log("Received open request from %s on port %d.", *recv_addr)
+        (bit_signature, request_type, f_name) = fields
         f_name = f_name.replace('\x00', "").strip()
         
         try: 
             f_handle = open(f_name, "rb")
-            print "Opened file:", f_name
+            self.log("Opened file: %s", f_name)
             self.handle_number += 1
             f_handle_no = self.handle_number
             f_size = os.path.getsize(f_name)
@@ -137,20 +186,21 @@ class Server(object):
             self.update_context_record(f_handle_no)
             status = True
         except Exception as exception_:
-            print "Open response error:", exception_
+            self.log("Open response error: %s", exception_)
             status = False
             f_size = 0
             f_handle_no = 0
             
-        print "Client %s given handle %d" % recv_addr, f_handle_no
-        response_packet = struct.pack("!2I?Q2I", 0b1101, 0b1000, status, f_size, self.epoch_number, f_handle_no)
+        self.log("Client %s on port %d given handle %d", recv_addr[0], recv_addr[1], f_handle_no)
+        response_packet = encode_open_response(status, f_size, self.epoch_number, f_handle_no)
         self.udp_socket.sendto(response_packet, recv_addr)
-        print "Sent open response."
+        self.log("Sent open response.")
         
     
-    def send_read_response(self, packet, recv_addr):
+    def send_read_response(self, fields, recv_addr):
         """
-        Parses a read-request, then replies with an appropriate read-response.
+        Takes the unpacked fields of a read-request, then replies with an 
+        appropriate read-response.
         
         Receives:
         recv_epoch_number, recv_handle_number, read_start_pos, read_size
@@ -158,66 +208,65 @@ class Server(object):
         Sends:
         Bit_signature packet_type status epoch_number handle_number start_pos num_bytes_read bytes_read
         """
-        buff_size = 0
-        read_buffer = 0
-        print "Received read request from %s on port %d." % recv_addr
-        (recv_epoch_number, recv_handle_number, read_start_pos, read_size) = struct.unpack("!4I", packet)
+        response_packet = None
+        self.log("Received read request from %s on port %d.", *recv_addr)
+        (bit_signature, request_type, recv_epoch_number, recv_handle_number, 
+         read_start_pos, read_size) = fields
         # Returns False if f_handle doesn't exist in the context record
         f_handle = self.get_file_handle(recv_handle_number)
         
         if recv_epoch_number != self.epoch_number:
-            print "Epoch numbers do not match: Server = %d, Client = %d" % (self.epoch_number, recv_epoch_number)
+            self.log("Epoch numbers do not match: Server = %d, Client = %d", self.epoch_number, recv_epoch_number)
             status = 0b01
         elif not f_handle:
-            print "Handle %d does not exist in context record." % recv_handle_number
+            self.log("Handle %d does not exist in context record.", recv_handle_number)
             status = 0b10
         else:
             status = 0b00
             try:
-                print "Read from file at byte %d" % read_start_pos
-                f_handle.seek(read_start_pos)
-                read_buffer = f_handle.read(read_size)
-                buff_size = len(read_buffer)
+                self.log("Read from file at byte %d", read_start_pos)
+                # Read straight into the response buffer, after the header
+                response_packet = encode_read_response(self.read_response, status, 
+                                                       self.epoch_number, recv_handle_number, 
+                                                       read_start_pos, f_handle, read_size)
             except Exception as exception_:
-                print "Read response error:", exception_
+                self.log("Read response error: %s", exception_)
                 status = 0b11
                 f_handle.close()
-            
-        response_header = struct.pack('!2IH3IQ', 0b1101, 0b0010, status, 
-                                      self.epoch_number, recv_handle_number, 
-                                      read_start_pos, buff_size)
-        
-        response_packet = response_header + read_buffer
         
+        if response_packet is None:
+            response_packet = encode_read_error(self.read_response, status, self.epoch_number, 
+                                                recv_handle_number, read_start_pos)
         self.udp_socket.sendto(response_packet, recv_addr)
-        print "Sent read response."
+        self.log("Sent read response.")
     
     
-    def recv_close_request(self, packet, recv_addr):
+    def recv_close_request(self, fields, recv_addr):
         """
-        Parses a close-request, then closes the file that was associated with
-        that client.
+        Takes the unpacked fields of a close-request, then closes the file that 
+        was associated with that client.
       
         Receives:
         recv_epoch_number, recv_handle_number
         """
-        print "Received close request from %s on port %d." % recv_addr
-        (recv_epoch_number, recv_handle_number) = struct.unpack("!2I", packet)
+        self.log("Received close request from %s on port %d.", *recv_addr)
+        (bit_signature, request_type, recv_epoch_number, recv_handle_number) = fields
         
         f_handle = self.get_file_handle(recv_handle_number)
         
         if recv_epoch_number != self.epoch_number:
-            print "Close error:\nEpoch numbers do not match: Server = %d, Client = %d"
+            self.log("Close error:\nEpoch numbers do not match: Server = %d, Client = %d", 
+                     self.epoch_number, recv_epoch_number)
             return
         elif not f_handle:
-            print "Close error: Handle %d does not exist in context record" % recv_handle_number
+            self.log("Close error: Handle %d does not exist in context record", recv_handle_number)
             return
         else:
             try:
-                print "Closing file:", f_handle
+                self.log("Closing file: %s", f_handle)
                 f_handle.close()
             except Exception as exception_:
-                print "Close error:", exception_
+                self.log("Close error: %s", exception_)
             
         
     def recv_invalid_request(self, packet, recv_addr):
@@ -225,14 +274,12 @@ class Server(object):
         Prints a message informing of an invalid packet, and then drops the
         packet.
         """ 
-        print "Received invalid request from %s on port %d" % recv_addr
-        print "Packet data (%d bytes)\n---START---" % len(packet)
-        print packet
-        print "---END---"
+        self.log("Received invalid request from %s on port %d", *recv_addr)
+        self.log("Packet data (%d bytes)\n---START---\n%s\n---END---", len(packet), packet)
         
         packet = None
         
-        print "Dropped packet."
+        self.log("Dropped packet.")
         
     
     def update_context_record(self, handle_number):
@@ -246,14 +293,14 @@ class Server(object):
         expiry_list = []
         for key, (f_han, i_time, time_tl) in records:
             if (clock() - i_time) > time_tl:
-                print "Handle %d has timed out." % key
+                self.log("Handle %d has timed out.", key)
                 expiry_list.append(key)
                 
         (f_han, i_time, time_tl) = self.context_record.get(handle_number)
         i_time = clock()
         self.context_record[handle_number] = (f_han, i_time, time_tl)
         for key in expiry_list:
-            print "Deleting handle %d." % key
+            self.log("Deleting handle %d.", key)
             del self.context_record[key]
 
             
@@ -272,53 +319,69 @@ class Server(object):
         
     def parse_recv_data(self, packet_bytes, recv_addr):
         """
-        When a packet is received, it is stripped of the header, and then the 
-        payload is sent to the corresponding function to be processed, based on 
-        the request_type field.
+        When a packet is received, it is decoded by protocol.decode_request(), 
+        and invalid packets are dropped. The fields of a valid request are sent 
+        to the corresponding function to be processed, looked up in 
+        self.request_handlers by the request_type field.
         
-        The bit signature is 1101 = 13 = \x00\x00\x00\r
-        
-        Packet type values:
-        1 = 0b0001 = read request = \x00\x00\x00\x01
-        2 = 0b0010 = read response = \x00\x00\x00\x02
-        4 = 0b0100 = open request = \x00\x00\x00\x04
-        8 = 0b1000 = open response = \x00\x00\x00\x08
-        9 = 0b1001 = close request = \x00\x00\x00\x09
+        See protocol.py for the bit signature and packet type values.
         """
-        bit_signature = packet_bytes[:4]
-        request_type = packet_bytes[4:8]
-        payload = packet_bytes[8:]
-        
-        # Bit signature of 13 to identify our packets
-        if bit_signature != "\x00\x00\x00\r":
+        fields = decode_request(packet_bytes)
+        if fields is None:
             self.recv_invalid_request(packet_bytes, recv_addr)
         else:
-            if request_type == "\x00\x00\x00\x09": # Type 1001
-                self.recv_close_request(payload, recv_addr)
-            elif request_type == "\x00\x00\x00\x01": # Type 0001
-                self.send_read_response(payload, recv_addr)
-            elif request_type == "\x00\x00\x00\x04": # Type 0100
-                self.send_open_response(payload, recv_addr)
-            else:
-                self.recv_invalid_request(packet_bytes, recv_addr)
+            self.request_handlers[fields[1]](fields, recv_addr)
                 
         
     def listen(self):
         """
-        Enters into an infinite loop and listens on the specified UDP socket.
-        If there is a packet, it is passed to a receiver function.
+        Enters into a loop and listens on the specified UDP socket until 
+        stop() is called. If there is a packet, it is passed to a receiver 
+        function.
         Drops a packet if the random error value > p_err.
         """
-        print ("Listening at address %s on port %d." % (self.ip, self.port))
-        while (1):
+        self.log("Listening at address %s on port %d.", self.ip, self.port)
+        while not self.stop_event.is_set():
+            # Wake up periodically so that a call to stop() is noticed
+            inputready, outputready, exceptready = select.select([self.udp_socket], [], [], 0.5)
+            if (inputready == []):
+                continue
             (packet_bytes, recv_addr) = self.udp_socket.recvfrom(self.buffer_)
             if packet_bytes and (random.uniform(0,1) >= self.p_err):
                 self.parse_recv_data(packet_bytes, recv_addr)
             else:
                 packet_bytes = None
-                print "Packet errors too high. Dropped packet."
+                self.log("Packet errors too high. Dropped packet.")
                 continue
                 
+    
+    def start(self):
+        """
+        Runs listen() in a background thread, so that the server can be used 
+        in-process. Returns immediately.
+        """
+        self.listen_thread = threading.Thread(target=self.listen)
+        self.listen_thread.daemon = True
+        self.listen_thread.start()
+        
+    
+    def stop(self):
+        """
+        Stops the listen loop, waits for the background thread if there is 
+        one, then closes the socket and any files still open in the context 
+        record.
+        """
+        self.stop_event.set()
+        if self.listen_thread is not None:
+            self.listen_thread.join()
+            self.listen_thread = None
+        self.udp_socket.close()
+        for (f_handle, init_time, ttl) in self.context_record.values():
+            f_handle.close()
+        self.context_record = {}
             
             
-server_process = Server()
+if __name__ == '__main__':
+    port, p_err = Server.get_args()
+    server_process = Server(port, p_err, verbose=True)
+    server_process.listen()
@@ -0,0 +1,161 @@
+"""
+:title: test_protocol.py
+:description: Tests for encoding and decoding packets
+
+Usage:
+
+python -m unittest test_protocol
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from protocol import (BIT_SIGNATURE, HEADER_SIZE, READ_REQUEST_TYPE, READ_RESPONSE_TYPE,
+                      OPEN_REQUEST_TYPE, OPEN_RESPONSE_TYPE, CLOSE_REQUEST_TYPE,
+                      READ_RESPONSE, READ_RESPONSE_HEADER_SIZE, MAX_READ_SIZE,
+                      PACKET_TYPES, PACKET_SIZES, REQUEST_PACKET_TYPES, REQUEST_TYPES,
+                      ReadResponseBuffer, new_packet_buffer, encode_open_request,
+                      encode_open_response, encode_read_request, encode_close_request,
+                      encode_read_response, encode_read_error, decode_request,
+                      decode_response)
+from server import Server
+
+# Fields of a packet of each type, header included
+PACKET_FIELDS = {
+    READ_REQUEST_TYPE: (BIT_SIGNATURE, READ_REQUEST_TYPE, 3, 4, 2800, 1400),
+    READ_RESPONSE_TYPE: (BIT_SIGNATURE, READ_RESPONSE_TYPE, 0, 3, 4, 2800, 1400),
+    OPEN_REQUEST_TYPE: (BIT_SIGNATURE, OPEN_REQUEST_TYPE, "file.txt".ljust(100, "\x00")),
+    OPEN_RESPONSE_TYPE: (BIT_SIGNATURE, OPEN_RESPONSE_TYPE, True, 5000, 3, 4),
+    CLOSE_REQUEST_TYPE: (BIT_SIGNATURE, CLOSE_REQUEST_TYPE, 3, 4),
+}
+
+# Packets that the server must drop without calling any handler
+MALFORMED_PACKETS = [
+    "",
+    "xyz",
+    # Read request header with a short payload
+    "\x00\x00\x00\r\x00\x00\x00\x01ab",
+    # Read request with trailing bytes
+    "\x00\x00\x00\r\x00\x00\x00\x01" + "\x00" * 20,
+    # Wrong bit signature
+    "\x00\x00\x00\x0c\x00\x00\x00\x01" + "\x00" * 16,
+    # Close request type in a packet the size of a read request
+    "\x00\x00\x00\r\x00\x00\x00\x09" + "\x00" * 16,
+    # Read response sent to the server
+    "\x00\x00\x00\r\x00\x00\x00\x02" + "\x00" * 22,
+]
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(sorted(PACKET_FIELDS), sorted(PACKET_TYPES))
+        for (packet_type, packet) in PACKET_TYPES.items():
+            fields = PACKET_FIELDS[packet_type]
+            packet_bytes = packet.pack(*fields)
+            self.assertEqual(len(packet_bytes), PACKET_SIZES[packet_type])
+            self.assertEqual(packet.unpack(packet_bytes), fields)
+
+    def test_encode_decode_requests(self):
+        encoders = {
+            READ_REQUEST_TYPE: encode_read_request,
+            OPEN_REQUEST_TYPE: encode_open_request,
+            CLOSE_REQUEST_TYPE: encode_close_request,
+        }
+        self.assertEqual(sorted(encoders), sorted(REQUEST_PACKET_TYPES))
+        for (packet_type, encode) in encoders.items():
+            fields = PACKET_FIELDS[packet_type]
+            self.assertEqual(decode_request(encode(*fields[2:])), fields)
+
+    def test_encode_decode_open_response(self):
+        fields = PACKET_FIELDS[OPEN_RESPONSE_TYPE]
+        packet_bytes = encode_open_response(*fields[2:])
+        self.assertEqual(decode_response(packet_bytes, OPEN_RESPONSE_TYPE), fields)
+        self.assertIsNone(decode_response(packet_bytes, READ_RESPONSE_TYPE))
+        self.assertIsNone(decode_response(packet_bytes[:-1], OPEN_RESPONSE_TYPE))
+
+    def test_decode_malformed_requests(self):
+        for packet_bytes in MALFORMED_PACKETS:
+            self.assertIsNone(decode_request(packet_bytes), repr(packet_bytes))
+
+    def test_request_types_have_different_sizes(self):
+        self.assertEqual(len(REQUEST_TYPES), len(REQUEST_PACKET_TYPES))
+        for packet_type in REQUEST_PACKET_TYPES:
+            self.assertEqual(REQUEST_TYPES[PACKET_SIZES[packet_type]], packet_type)
+
+    def test_new_packet_buffer(self):
+        packet_buffer = new_packet_buffer(READ_RESPONSE_TYPE, READ_RESPONSE, 10)
+        self.assertEqual(len(packet_buffer), READ_RESPONSE_HEADER_SIZE + 10)
+        self.assertEqual(str(packet_buffer[:HEADER_SIZE]), "\x00\x00\x00\r\x00\x00\x00\x02")
+
+
+class ReadResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3500)
+        (data_fd, self.data_filename) = tempfile.mkstemp()
+        os.write(data_fd, self.data)
+        os.close(data_fd)
+        self.f_handle = open(self.data_filename, "rb")
+        self.response_buffer = ReadResponseBuffer()
+
+    def tearDown(self):
+        self.f_handle.close()
+        os.remove(self.data_filename)
+
+    def read_block(self, start_position, read_size=1400):
+        packet = encode_read_response(self.response_buffer, 0, 3, 4, start_position,
+                                      self.f_handle, read_size)
+        fields = decode_response(packet.tobytes(), READ_RESPONSE_TYPE)
+        self.assertEqual(fields, (BIT_SIGNATURE, READ_RESPONSE_TYPE, 0, 3, 4,
+                                  start_position, len(packet) - READ_RESPONSE_HEADER_SIZE))
+        return packet[READ_RESPONSE_HEADER_SIZE:].tobytes()
+
+    def test_blocks_in_and_out_of_order(self):
+        # In order, which skips the seek, then out of order and repeated
+        for start_position in [0, 1400, 2800, 3500, 1400, 0, 0, 2800]:
+            self.assertEqual(self.read_block(start_position),
+                             self.data[start_position:start_position + 1400])
+
+    def test_read_size_changes(self):
+        self.assertEqual(self.read_block(0, 100), self.data[:100])
+        self.assertEqual(self.read_block(100, 1400), self.data[100:1500])
+        self.assertEqual(self.read_block(1500, MAX_READ_SIZE + 1), self.data[1500:])
+
+    def test_error(self):
+        packet = encode_read_error(self.response_buffer, 0b10, 3, 4, 1400)
+        self.assertEqual(decode_response(packet.tobytes(), READ_RESPONSE_TYPE),
+                         (BIT_SIGNATURE, READ_RESPONSE_TYPE, 0b10, 3, 4, 1400, 0))
+        self.assertEqual(len(packet), READ_RESPONSE_HEADER_SIZE)
+
+
+class ParseRecvDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = Server(ip='127.0.0.1', epoch_file=os.path.join(self.tmp_dir, "epoch.number"))
+        self.calls = []
+        for packet_type in self.server.request_handlers:
+            self.server.request_handlers[packet_type] = self.stub_handler
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def stub_handler(self, fields, recv_addr):
+        self.calls.append(fields)
+
+    def test_malformed_packets_are_dropped(self):
+        for packet_bytes in MALFORMED_PACKETS:
+            self.server.parse_recv_data(packet_bytes, ('127.0.0.1', 6060))
+        self.assertEqual(self.calls, [])
+
+    def test_valid_packet_is_dispatched(self):
+        fields = PACKET_FIELDS[CLOSE_REQUEST_TYPE]
+        self.server.parse_recv_data(encode_close_request(*fields[2:]), ('127.0.0.1', 6060))
+        self.assertEqual(self.calls, [fields])
+
+
+if __name__ == '__main__':
+    unittest.main()
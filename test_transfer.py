@@ -0,0 +1,143 @@
+"""
+:title: test_transfer.py
+:description: Tests for downloading files from an in-process server
+
+Usage:
+
+python -m unittest test_transfer
+"""
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from client import Client, TransferError, download
+from protocol import BIT_SIGNATURE, READ_RESPONSE_TYPE, READ_RESPONSE_PACKET
+from server import Server
+
+
+class DuplicatingServer(Server):
+    """Server that sends its first read response twice, like a network duplicating a packet."""
+
+    duplicated = False
+    num_read_requests = 0
+
+    def send_read_response(self, fields, recv_addr):
+        self.num_read_requests += 1
+        Server.send_read_response(self, fields, recv_addr)
+        if not self.duplicated:
+            self.duplicated = True
+            Server.send_read_response(self, fields, recv_addr)
+
+
+class BadStatusServer(Server):
+    """Server that answers every read request with a status the client does not know."""
+
+    def send_read_response(self, fields, recv_addr):
+        (bit_signature, request_type, recv_epoch_number, recv_handle_number, 
+         read_start_pos, read_size) = fields
+        response_packet = READ_RESPONSE_PACKET.pack(BIT_SIGNATURE, READ_RESPONSE_TYPE, 7, 
+                                                    self.epoch_number, recv_handle_number, 
+                                                    read_start_pos, 0)
+        self.udp_socket.sendto(response_packet, recv_addr)
+
+
+class TransferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def new_server(self, server_class=Server):
+        return server_class(ip='127.0.0.1', epoch_file=os.path.join(self.tmp_dir, "epoch.number"))
+
+    def write_file(self, name, size):
+        data = os.urandom(size)
+        with open(os.path.join(self.tmp_dir, name), "wb") as f:
+            f.write(data)
+        return data
+
+    def download_bytes(self, server, name):
+        chunks = []
+        for chunk in download(os.path.join(self.tmp_dir, name), ('127.0.0.1', server.port)):
+            self.assertIsInstance(chunk, memoryview)
+            chunks.append(chunk.tobytes())
+        return "".join(chunks)
+
+    def test_download(self):
+        data = self.write_file("src.bin", 5000)
+        with self.new_server() as server:
+            self.assertNotEqual(server.port, 0)
+            received = self.download_bytes(server, "src.bin")
+        self.assertEqual(hashlib.md5(received).hexdigest(), hashlib.md5(data).hexdigest())
+
+    def test_download_exact_multiple_of_block_size(self):
+        # The last read response holds no data
+        data = self.write_file("src.bin", Client.NUM_BYTES_TO_READ * 3)
+        with self.new_server() as server:
+            received = self.download_bytes(server, "src.bin")
+        self.assertEqual(received, data)
+
+    def test_download_empty_file(self):
+        self.write_file("empty.bin", 0)
+        with self.new_server() as server:
+            self.assertEqual(self.download_bytes(server, "empty.bin"), "")
+
+    def test_many_downloads_from_one_server(self):
+        data = self.write_file("src.bin", 3000)
+        with self.new_server() as server:
+            for i in range(3):
+                self.assertEqual(self.download_bytes(server, "src.bin"), data)
+
+    def test_missing_file(self):
+        with self.new_server() as server:
+            self.assertRaises(TransferError, self.download_bytes, server, "missing.bin")
+
+    def test_unknown_read_status(self):
+        self.write_file("src.bin", 3000)
+        with self.new_server(BadStatusServer) as server:
+            self.assertRaises(TransferError, self.download_bytes, server, "src.bin")
+
+    def test_duplicated_response_is_dropped(self):
+        for size in [5000, Client.NUM_BYTES_TO_READ * 10]:
+            data = self.write_file("src.bin", size)
+            with self.new_server(DuplicatingServer) as server:
+                received = self.download_bytes(server, "src.bin")
+            self.assertEqual(received, data)
+            # The duplicate must not make the client send any extra read requests. A file 
+            # that is an exact multiple of the block size ends with a read of no data.
+            num_blocks = -(-size // Client.NUM_BYTES_TO_READ)
+            if size % Client.NUM_BYTES_TO_READ == 0:
+                num_blocks += 1
+            self.assertEqual(server.num_read_requests, num_blocks)
+
+    def test_invalid_requests_are_dropped(self):
+        data = self.write_file("src.bin", 3000)
+        with self.new_server() as server:
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for packet in ["xyz",
+                           # Read request header with a short payload
+                           "\x00\x00\x00\r\x00\x00\x00\x01ab",
+                           # Read request with trailing bytes
+                           "\x00\x00\x00\r\x00\x00\x00\x01" + "\x00" * 20,
+                           # Wrong bit signature
+                           "\x00\x00\x00\x0c\x00\x00\x00\x01" + "\x00" * 16,
+                           # Close request type in a packet the size of a read request
+                           "\x00\x00\x00\r\x00\x00\x00\x09" + "\x00" * 16]:
+                sender.sendto(packet, ('127.0.0.1', server.port))
+            sender.close()
+            self.assertEqual(self.download_bytes(server, "src.bin"), data)
+
+    def test_start_and_stop(self):
+        server = self.new_server()
+        server.start()
+        server.stop()
+        self.assertIsNone(server.listen_thread)
+
+
+if __name__ == '__main__':
+    unittest.main()